@@ -12,13 +12,21 @@ License : MIT
 _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _
 """
 import os
+import re
 import sys
 import json
+import math
+import mmap
 import struct
+import functools
 import argparse
 import numpy as np
-from safetensors       import safe_open
-from safetensors.numpy import save_file
+
+# use `orjson` to decode safetensors headers if it's available (a lot faster than `json`)
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json   import loads as json_loads
 
 # scale_factor/shift_factor values used for the latent space of different models
 SCALE_AND_SHIFT_BY_LATENT_FORMAT = {
@@ -29,6 +37,35 @@ SCALE_AND_SHIFT_BY_LATENT_FORMAT = {
 }
 VALID_LATENT_FORMATS = tuple(SCALE_AND_SHIFT_BY_LATENT_FORMAT.keys())
 
+# the same scale_factor/shift_factor values stored in a tuple indexed by latent format number
+LATENT_FORMAT_INDEX = {latent_format: index for index, latent_format in enumerate(VALID_LATENT_FORMATS)}
+SCALE_AND_SHIFT     = tuple(SCALE_AND_SHIFT_BY_LATENT_FORMAT.values())
+
+# numpy data types corresponding to each dtype code used in safetensors headers
+# (prebuilt `np.dtype` objects, so they are not re-parsed for each loaded tensor)
+# safetensors data is always little-endian, so the byte order is explicit
+# BF16 and F8 types are not included because numpy has no native equivalent
+SAFETENSORS_DTYPES = {
+    "F64" : np.dtype("<f8"),
+    "F32" : np.dtype("<f4"),
+    "F16" : np.dtype("<f2"),
+    "I64" : np.dtype("<i8"),
+    "I32" : np.dtype("<i4"),
+    "I16" : np.dtype("<i2"),
+    "I8"  : np.dtype("i1"),
+    "U64" : np.dtype("<u8"),
+    "U32" : np.dtype("<u4"),
+    "U16" : np.dtype("<u2"),
+    "U8"  : np.dtype("u1"),
+    "BOOL": np.dtype("?")
+}
+SAFETENSORS_DTYPE_CODES = {dtype: code for code, dtype in SAFETENSORS_DTYPES.items()}
+
+# rank of each dtype code, following the order of the `Dtype` enum in the safetensors
+# library (it stores the tensors sorted by descending rank and then by name)
+SAFETENSORS_DTYPE_RANKS = {code: rank for rank, code in enumerate(
+    ("BOOL", "U8", "I8", "I16", "U16", "F16", "I32", "U32", "F32", "F64", "I64", "U64") )}
+
 # exit code to use in case of fatal error (i.e. an unrecoverable problem)
 FATAL_ERROR_CODE = 1
 
@@ -105,14 +142,59 @@ def find_unique_path(path: str) -> str:
     if not os.path.exists(path):
         return path
     base_name, extension = os.path.splitext(path)
-    for number in range(1, 1000000):
-        new_path = f"{base_name}_{number:02d}{extension}"
-        if not os.path.exists(new_path) or number == 999999:
-            return new_path
+    MAX_NUMBER = 999999
+
+    def numbered_path(number: int) -> str:
+        return f"{base_name}_{number:02d}{extension}"
+
+    # probe numbers 1, 2, 4, 8, ... until one is free
+    # (`lowest` is always a number already taken, 0 being the original path)
+    lowest, highest = 0, 1
+    while highest < MAX_NUMBER and os.path.exists(numbered_path(highest)):
+        lowest, highest = highest, min(highest * 2, MAX_NUMBER)
+
+    # binary search between the last taken number and the free one
+    # (assumes that the numbered files were created consecutively)
+    while highest - lowest > 1:
+        middle = (lowest + highest) // 2
+        if os.path.exists(numbered_path(middle)):
+            lowest = middle
+        else:
+            highest = middle
+    return numbered_path(highest)
 
 
 #--------------------------------- TENSORS ---------------------------------#
 
+def _read_safetensors_header(file_path : str,
+                             size_limit: int = 67108864
+                             ) -> tuple[dict, int]:
+    """
+    Reads the header of a safetensors file.
+    Returns a tuple `(header, header_length)` where `header_length` is the size in bytes
+    of the JSON header (tensor data starts at `8+header_length`), or `([], 0)` if the
+    header can't be read.
+    """
+    try:
+        with open(file_path, "rb") as f:
+
+            # verify that the file has at least 8 bytes (the minimum size for a header)
+            # (fstat on the already open file avoids a separate stat of the path)
+            if os.fstat(f.fileno()).st_size < 8:
+                return [], 0
+
+            # read the first 8 bytes to get the header length and decode the header data
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            if header_length > size_limit:
+                return [], 0
+            header = json_loads( f.read(header_length) )
+            return header, header_length
+
+    # handle exceptions that may occur during header reading or decoding
+    except (ValueError, json.JSONDecodeError, IOError):
+        return [], 0
+
+
 def get_safetensors_header(file_path : str,
                            size_limit: int = 67108864
                            ) -> dict:
@@ -122,22 +204,31 @@ def get_safetensors_header(file_path : str,
         file_path  (str): Path to the .safetensors file.
         size_limit (int): Maximum allowed size for the header (a protection against large headers)
     """
-    try:
-        # verify that the file has at least 8 bytes (the minimum size for a header)
-        if os.path.getsize(file_path) < 8:
-            return []
+    header, _ = _read_safetensors_header(file_path, size_limit)
+    return header
 
-        # read the first 8 bytes to get the header length and decode the header data
-        with open(file_path, "rb") as f:
-            header_length = struct.unpack("<Q", f.read(8))[0]
-            if header_length > size_limit:
-                return []
-            header = json.loads( f.read(header_length) )
-            return header
 
-    # handle exceptions that may occur during header reading or decoding
-    except (ValueError, json.JSONDecodeError, IOError):
-        return []
+@functools.lru_cache(maxsize=32)
+def _cached_safetensors_header(file_path: str, mtime: int, size: int) -> tuple[dict, int]:
+    """Reads the safetensors header, caching it by path, modification time and size."""
+    return _read_safetensors_header(file_path)
+
+
+def get_cached_safetensors_header(file_path: str) -> tuple[dict, int]:
+    """
+    Returns the safetensors file header reusing the one already read from the file
+    if the file has not been modified since then. (avoids reading it twice when it is
+    first identified and then loaded)
+    Args:
+        file_path (str): Path to the .safetensors file.
+    Returns:
+        A tuple `(header, header_length)`, or `([], 0)` if the header can't be read.
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return [], 0
+    return _cached_safetensors_header(file_path, stat.st_mtime_ns, stat.st_size)
 
 
 def get_tensor_prefix(state_dict    : dict,
@@ -152,11 +243,12 @@ def get_tensor_prefix(state_dict    : dict,
         not_containing (str): If provided, specifies that the keys returned should not contain this substring.
     """
     # iterate over all keys in the state dictionary
-    for key in state_dict.keys():
-        if key.endswith(postfix):
-            if (not_containing is not None) and (not_containing in key):
-                continue
-            return key[:-len(postfix)]
+    # (`removesuffix` returns the same key if it doesn't end with the postfix,
+    #  the substring search is done only on keys that do end with it)
+    for key in state_dict:
+        if (prefix := key.removesuffix(postfix)) != key:
+            if (not_containing is None) or (not_containing not in key):
+                return prefix
 
     # if no key matches the postfix, return an empty string
     return ""
@@ -175,7 +267,7 @@ def load_tensors(path         : str,
         target_prefix (str): The prefix used as replacement of the original prefix.
                              If empty, the original prefix is removed and not replaced.
     Returns:
-        dict: A dictionary containing the loaded tensors.
+        dict: A dictionary containing the loaded tensors as read-only views of the file.
     """
     # ensure the prefixes end with a dot
     if prefix and not prefix.endswith('.'):
@@ -183,18 +275,90 @@ def load_tensors(path         : str,
     if target_prefix and not target_prefix.endswith('.'):
         target_prefix += '.'
 
-    # load the tensors from the file with the specified prefix
+    # parse the header to know where each tensor is located inside the file
+    header, header_length = get_cached_safetensors_header(path)
+    if not header_length:
+        raise ValueError(f"Invalid safetensors file '{path}'")
+    data_start = 8 + header_length
+
+    # map the whole file in memory and create the tensors with the specified prefix
+    # directly over the mapped data, without copying it (the tensors are read-only
+    # views and each one keeps a reference to the mapping, so it stays open while
+    # any of them is alive; the only copy is the one done later when saving)
+    with open(path, "rb") as f:
+        mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
     tensors = {}
     prefix_len = len(prefix)
-    with safe_open(path, framework="numpy", device='cpu') as f:
-        for key in f.keys():
-            if key.startswith(prefix):
-                target_key = target_prefix + key[prefix_len:]
-                tensors[target_key] = f.get_tensor(key)
-
+    for key, info in header.items():
+        if key == "__metadata__" or not key.startswith(prefix):
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"Unsupported data type '{info['dtype']}' for tensor '{key}' in '{path}'")
+        # verify that the location of the tensor data is consistent with
+        # its shape and that it is inside the file before creating the view
+        begin, end = info["data_offsets"]
+        if end - begin != dtype.itemsize * math.prod(info["shape"]):
+            raise ValueError(f"Data size of tensor '{key}' does not match its shape in '{path}'")
+        if data_start + end > len(mapped_file):
+            raise ValueError(f"Data of tensor '{key}' is beyond the end of '{path}' (truncated file?)")
+
+        target_key = target_prefix + key[prefix_len:]
+        tensors[target_key] = np.ndarray(info["shape"],
+                                         dtype  = dtype,
+                                         buffer = mapped_file,
+                                         offset = data_start + begin)
     return tensors
 
 
+def save_tensors(state_dict: dict,
+                 file_path : str
+                 ) -> None:
+    """
+    Save the tensors to a safetensors file.
+
+    The data of each tensor is written directly from its own memory, so tensors
+    loaded with `load_tensors()` are copied straight from the mapped source file
+    without being first serialized into an intermediate buffer.
+    Args:
+        state_dict (dict): The tensors to save.
+        file_path   (str): The path to the safetensors file to create.
+    """
+    # get the safetensors dtype code of each tensor
+    dtype_codes = {}
+    for key, tensor in state_dict.items():
+        dtype = tensor.dtype.newbyteorder("<")
+        if dtype not in SAFETENSORS_DTYPE_CODES:
+            raise ValueError(f"Unsupported data type '{tensor.dtype}' for tensor '{key}'")
+        dtype_codes[key] = SAFETENSORS_DTYPE_CODES[dtype]
+
+    # like the `safetensors` library, store the tensors sorted by
+    # data type rank (highest first) and then by name
+    keys = sorted(state_dict, key=lambda key: (-SAFETENSORS_DTYPE_RANKS[dtype_codes[key]], key))
+
+    # build the header with the location of each tensor inside the data section
+    header = {}
+    offset = 0
+    for key in keys:
+        tensor = state_dict[key]
+        header[key] = {"dtype"       : dtype_codes[key],
+                       "shape"       : list(tensor.shape),
+                       "data_offsets": [offset, offset + tensor.nbytes]}
+        offset += tensor.nbytes
+
+    # the header is padded with spaces so the data section starts 8-byte aligned
+    header_data  = json.dumps(header, separators=(',', ':')).encode("utf-8")
+    header_data += b" " * (-len(header_data) % 8)
+
+    with open(file_path, "wb") as f:
+        f.write( struct.pack("<Q", len(header_data)) )
+        f.write( header_data )
+        for key in keys:
+            tensor = state_dict[key]
+            f.write( np.ascontiguousarray(tensor, dtype=tensor.dtype.newbyteorder("<")).data )
+
+
 def shift_layers(state_dict  : dict,
                  layer_prefix: str,
                  layer_offset: int
@@ -202,66 +366,64 @@ def shift_layers(state_dict  : dict,
     """
     Shifts the layers of a model by a specified offset.
 
+    The keys are renamed in place, so the provided dictionary is modified.
     Args:
         state_dict    (dict): The original model parameters.
         layer_prefix   (str): The prefix used to identify the layers to shift.
         layer_offset   (int): The number of layers to shift. Positive values shift the
                               layers forward, negative values shift them backward.
     Returns:
-        dict: A dictionary containing the shifted tensors.
+        dict: The same dictionary containing the shifted tensors.
     """
-    fixed_dict = {}
-    for key, tensor in state_dict.items():
+    # matches "<layer_prefix><layer_number>" optionally followed by ".<anything>"
+    # (used with `fullmatch` so the whole key must match, including any trailing newline)
+    layer_pattern = re.compile(rf"{re.escape(layer_prefix)}(\d+)(\..*)?", re.DOTALL)
 
-        if not key.startswith(layer_prefix):
-            fixed_dict[key] = tensor
-            continue
+    # find the layers to shift, if there are none the dictionary is returned untouched
+    layer_matches = [(key, match) for key in state_dict if (match := layer_pattern.fullmatch(key))]
+    if not layer_matches:
+        return state_dict
 
-        _parts = key[len(layer_prefix):].split('.',1)
-        if not _parts[0].isdecimal():
-            fixed_dict[key] = tensor
-            continue
+    # remove all the layers to shift before inserting them again with the new number,
+    # this way a renamed layer never overwrites one that is still pending to be shifted
+    shifted_tensors = []
+    for key, match in layer_matches:
+        new_layer_number = int(match[1]) + layer_offset
+        dot_suffix       = match[2] or ""
+        shifted_tensors.append( (f"{layer_prefix}{new_layer_number}{dot_suffix}", state_dict.pop(key)) )
 
-        new_layer_number = int(_parts[0]) + layer_offset
-        dot_suffix       = f".{_parts[1]}" if len(_parts)>1 else ""
-        fixed_key        = f"{layer_prefix}{new_layer_number}{dot_suffix}"
-        fixed_dict[fixed_key] = tensor
-
-    return fixed_dict
+    state_dict.update(shifted_tensors)
+    return state_dict
 
 
 #----------------------------- IDENTIFICATION ------------------------------#
 
+# pairs of tensor names that, when both are present, identify a TAESD model:
+#   - taesd_decoder.safetensors, taesd_encoder.safetensors, taesdxl_decoder.safetensors, ...
+#   - diffusion_pytorch_model.safetensors (SD, SDXL, SD3 and FLUX.1 diffusers version)
+TAESD_SENTINEL_KEYS = (
+    frozenset(( "3.conv.4.bias"                , "8.conv.0.weight"                )),
+    frozenset(( "decoder.layers.3.conv.4.bias" , "decoder.layers.8.conv.0.weight" )),
+    frozenset(( "encoder.layers.4.conv.4.bias" , "encoder.layers.8.conv.0.weight" )),
+)
+# tensor root names that also identify a TAESD model
+TAESD_ROOT_NAMES = ("taesd", "taesdxl", "taesd3", "taef1")
+
 def is_taesd(state_dict: dict) -> bool:
     """
     Returns True if the model parameters correspond to a Tiny AutoEncoder (TAESD) model.
     Args:
         state_dict (dict): The model parameters as a dictionary.
     """
-    # recognize the following files based on their structure:
-    #   - taesd_decoder.safetensors
-    #   - taesd_encoder.safetensors
-    #   - taesdxl_decoder.safetensors
-    #   - taesdxl_encoder.safetensors
-    #
-    if  "3.conv.4.bias"   in state_dict and \
-        "8.conv.0.weight" in state_dict:
-        return True
-
-    # recognize the following diffusers files based on their structure:
-    #   - diffusion_pytorch_model.safetensors (SD, SDXL, SD3 and FLUX.1 version)
-    #
-    if  "decoder.layers.3.conv.4.bias"   in state_dict and \
-        "decoder.layers.8.conv.0.weight" in state_dict:
-        return True
-    if  "encoder.layers.4.conv.4.bias"   in state_dict and \
-        "encoder.layers.8.conv.0.weight" in state_dict:
+    # recognize the known files based on their structure (see TAESD_SENTINEL_KEYS)
+    keys = state_dict.keys()
+    if any(sentinel_keys <= keys for sentinel_keys in TAESD_SENTINEL_KEYS):
         return True
 
     # recognize any model whose tensor root name starts with some TAESD-related names
-    for key in state_dict.keys():
-        if key.startswith( ("taesd", "taesdxl", "taesd3", "taef1")  ):
-            return True
+    # (stops scanning as soon as one key matches)
+    if any(key.startswith(TAESD_ROOT_NAMES) for key in state_dict):
+        return True
 
     # none of the above conditions are met
     # therefore, it does not appear to be a `Tiny AutoEncoder` model
@@ -288,7 +450,7 @@ def is_taesd_with_role(file_path: str, state_dict: dict, role: str) -> bool:
     if not state_dict or not is_taesd(state_dict):
         return False
     subnames = ENCODER_TENSOR_SUBNAMES[role]
-    for key in state_dict.keys():
+    for key in state_dict:
         if any(subname in key for subname in subnames):
             return True
 
@@ -311,7 +473,7 @@ def find_taesd_with_role(input_files: list[str], role: str) -> tuple[str, str] |
     assert role in ("encoder", "decoder"), "Invalid role. Must be 'encoder' or 'decoder'."
     oposite_role = "decoder" if role == "encoder" else "encoder"
     for file in input_files:
-        header = get_safetensors_header(file)
+        header, _ = get_cached_safetensors_header(file)
         if is_taesd_with_role(file, header, role):
             tensor_prefix = get_tensor_prefix(header, ".3.conv.4.bias", not_containing=oposite_role)
             return (file, tensor_prefix)
@@ -357,8 +519,10 @@ def insert_emulation_layer(state_dict   : dict, *,
         target_prefix   (str): The prefix used for the emulation layer parameters.
         dtype      (np.dtype): The data type for the added parameters. Default is float32.
     """
-    state_dict.update( {target_prefix + "scale_factor": np.array(scale_factor, dtype=dtype)} )
-    state_dict.update( {target_prefix + "shift_factor": np.array(shift_factor, dtype=dtype)} )
+    # both factors share a single array, each parameter is a 0-d view of it
+    factors = np.array([scale_factor, shift_factor], dtype=dtype)
+    state_dict.update( {target_prefix + "scale_factor": factors[0, ...],
+                        target_prefix + "shift_factor": factors[1, ...]} )
 
 
 #-------------------------------- BUILDING ---------------------------------#
@@ -428,23 +592,28 @@ def build_tiny_transcoder(*,
 
     # add input/output emulation layers to emulate standard decoder+encoder in/out ranges
     if include_decoderencoder_emulation:
-        scale_and_shift = SCALE_AND_SHIFT_BY_LATENT_FORMAT[input_latent_format]
+        scale_and_shift = SCALE_AND_SHIFT[ LATENT_FORMAT_INDEX[input_latent_format] ]
         insert_emulation_layer(transcoder_tensors,
                                scale_factor  = scale_and_shift[0],
                                shift_factor  = scale_and_shift[1],
                                target_prefix = INPUT_EMULATION_PREFIX)
-        scale_and_shift = SCALE_AND_SHIFT_BY_LATENT_FORMAT[output_latent_format]
+        scale_and_shift = SCALE_AND_SHIFT[ LATENT_FORMAT_INDEX[output_latent_format] ]
         insert_emulation_layer(transcoder_tensors,
                                scale_factor  = scale_and_shift[0],
                                shift_factor  = scale_and_shift[1],
                                target_prefix = OUTPUT_EMULATION_PREFIX)
 
     # convert the data type (if required)
-    if dtype:
-        converted_tensors = {}
+    # all tensors are packed into a single contiguous buffer so that the
+    # conversion is done in one pass instead of once per (tiny) tensor
+    # (every value is a numpy array: loaded from file or created by the insert_* functions)
+    if dtype and any(tensor.dtype != dtype for tensor in transcoder_tensors.values()):
+        pool = np.concatenate([tensor.ravel() for tensor in transcoder_tensors.values()],
+                              dtype=dtype, casting="unsafe")
+        offset = 0
         for key, tensor in transcoder_tensors.items():
-            converted_tensors[key] = tensor.astype(dtype) if isinstance(tensor, np.ndarray) else tensor
-        transcoder_tensors = converted_tensors
+            transcoder_tensors[key] = pool[offset : offset+tensor.size].reshape(tensor.shape)
+            offset += tensor.size
 
     return transcoder_tensors
 
@@ -453,6 +622,10 @@ def build_tiny_transcoder(*,
 #////////////////////////////////// MAIN ///////////////////////////////////#
 #===========================================================================#
 
+# latent format selected by each of the `--from-*` / `--to-*` command-line flags
+FROM_FLAG_LATENT_FORMATS = {"from_sd": "sd", "from_sdxl": "sdxl", "from_sd3": "sd3", "from_flux": "f1"}
+TO_FLAG_LATENT_FORMATS   = {"to_sd"  : "sd", "to_sdxl"  : "sdxl", "to_sd3"  : "sd3", "to_flux"  : "f1"}
+
 def main(args: list=None, parent_script: str=None):
 
     # allow this command to be a subcommand of a larger tool (future expansion?)
@@ -493,35 +666,23 @@ def main(args: list=None, parent_script: str=None):
     # and the latent format to be used (sd, sdxl,...)
     from_latent_format = ""
     decoder_path       = ""
-    if args.from_sd:
-        from_latent_format = "sd"
-        decoder_path       = args.from_sd
-    elif args.from_sdxl:
-        from_latent_format = "sdxl"
-        decoder_path       = args.from_sdxl
-    elif args.from_sd3:
-        from_latent_format = "sd3"
-        decoder_path       = args.from_sd3
-    elif args.from_flux:
-        from_latent_format = "f1"
-        decoder_path       = args.from_flux
+    for flag, latent_format in FROM_FLAG_LATENT_FORMATS.items():
+        model_path = getattr(args, flag)
+        if model_path:
+            from_latent_format = latent_format
+            decoder_path       = model_path
+            break
 
     # determine which file the encoder will be loaded from
     # and the latent format to be used (sd, sdxl,...)
     to_latent_format = ""
     encoder_path     = ""
-    if args.to_sd:
-        to_latent_format = "sd"
-        encoder_path   = args.to_sd
-    elif args.to_sdxl:
-        to_latent_format = "sdxl"
-        encoder_path   = args.to_sdxl
-    elif args.to_sd3:
-        to_latent_format = "sd3"
-        encoder_path   = args.to_sd3
-    elif args.to_flux:
-        to_latent_format = "f1"
-        encoder_path   = args.to_flux
+    for flag, latent_format in TO_FLAG_LATENT_FORMATS.items():
+        model_path = getattr(args, flag)
+        if model_path:
+            to_latent_format = latent_format
+            encoder_path     = model_path
+            break
 
     # check that source/destination models are specified
     if not from_latent_format:
@@ -565,7 +726,7 @@ def main(args: list=None, parent_script: str=None):
 
     # save the state dict to a file
     print(f' > Saving "{output_file_path}"\n')
-    save_file(state_dict, output_file_path)
+    save_tensors(state_dict, output_file_path)
 
 
 if __name__ == "__main__":